@@ -1,4 +1,7 @@
 """ Pytorch dataset. """
+import os
+import glob
+import hashlib
 import torch
 from torch.utils.data import Dataset
 import numpy as np
@@ -8,6 +11,11 @@ from . import utils
 from . import data
 
 
+# Where evaluation caches normalized volumes (set BL3D_CACHE_DIR to change it)
+CACHE_DIR = os.environ.get('BL3D_CACHE_DIR', '/tmp/bl3d-cache')
+LCN_VERSION = 1  # part of cache filenames; bump when utils.lcn changes
+
+
 class DetectionDataset(Dataset):
     """ Dataset with input+labels needed to train a segmentation and centroid detection
     network (a la Tokuoka et al., 2018).
@@ -22,6 +30,11 @@ class DetectionDataset(Dataset):
             centroid mask. k will result in a 3-d disk of (2*k + 1) diameter.
         binarize_labels (bool): Whether labels would be binary or each cell will have a
             diff id.
+        cache_dir (str): Directory where local contrast normalized volumes are saved the
+            first time they are computed. Later datasets load them from here (memory-
+            mapped, so dataloader workers share the same pages). Cached files are keyed
+            by database, example_id, LCN_VERSION, lcn sigmas and a checksum of the raw
+            volume; stale files of the same example are deleted. None to avoid caching.
 
     Returns:
         A (volume, label, centroids) tuple:
@@ -32,15 +45,20 @@ class DetectionDataset(Dataset):
     """
 
     def __init__(self, examples, transform=None, normalize_volume=True, centroid_radius=2,
-                 binarize_labels=True):
+                 binarize_labels=True, cache_dir=None):
         print('Creating dataset with {}normalized examples {} and centroid radius {}'.format(
                 '' if normalize_volume else 'un', examples, centroid_radius))
 
         # Get volumes
         volumes_rel = data.Stack.Volume & [{'example_id': id_} for id_ in examples]
-        volumes = volumes_rel.fetch('volume', order_by='example_id')
+        example_ids, volumes = volumes_rel.fetch('example_id', 'volume',
+                                                 order_by='example_id')
         if normalize_volume:  # local contrast normalization
-            volumes = [utils.lcn(v, (3, 25, 25)) for v in volumes]
+            if cache_dir is None:
+                volumes = [utils.lcn(v, (3, 25, 25)) for v in volumes]
+            else:
+                volumes = [_cached_lcn(v, (3, 25, 25), id_, cache_dir) for id_, v in
+                           zip(example_ids, volumes)]
         self.volumes = [np.expand_dims(volume, 0) for volume in volumes]  # add channel dimension
 
         # Get labels
@@ -79,4 +97,37 @@ class DetectionDataset(Dataset):
         if self.transform is not None:
             example = self.transform(example)
 
-        return tuple(torch.as_tensor(x) for x in example)
\ No newline at end of file
+        return tuple(torch.as_tensor(x) for x in example)
+
+
+def _cached_lcn(volume, sigmas, example_id, cache_dir):
+    """ Local contrast normalize a volume or load it from cache_dir if this same volume
+    was already normalized with these sigmas.
+
+    Returns:
+        A d x h x w read-only memory-mapped array.
+    """
+    checksum = hashlib.md5(np.ascontiguousarray(volume).data)  # no copy if contiguous
+    checksum.update('{} {}'.format(volume.shape, volume.dtype).encode())
+    prefix = 'lcn_{}_{}_'.format(data.schema.database, example_id)
+    filename = os.path.join(cache_dir, '{}v{}_{}_{}.npy'.format(
+        prefix, LCN_VERSION, '-'.join(str(s) for s in sigmas), checksum.hexdigest()))
+    if not os.path.exists(filename):
+        norm = utils.lcn(volume, sigmas)
+
+        # Write to a temporary file first so other processes never read a partial file
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_filename = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            np.save(f, norm)
+        os.replace(tmp_filename, filename)
+
+        # Delete stale versions of this example (older volume, lcn version or sigmas)
+        for old_filename in glob.glob(os.path.join(cache_dir, prefix + '*.npy')):
+            if old_filename != filename:
+                try:
+                    os.remove(old_filename)
+                except FileNotFoundError:  # deleted by another process
+                    pass
+
+    return np.load(filename, mmap_mode='r')
@@ -1,6 +1,6 @@
 import datajoint as dj
+import os
 import numpy as np
-import bisect
 import torch
 from torch.utils import data
 
@@ -76,8 +76,10 @@ class SemanticMetrics(dj.Computed):
             'normalize_volume', 'centroid_radius')
         dataset = datasets.DetectionDataset(examples, transforms.ContrastNorm(),
                                             normalize_volume=normalize_volume,
-                                            centroid_radius=centroid_radius)
-        dataloader = data.DataLoader(dataset, num_workers=4, pin_memory=True)
+                                            centroid_radius=centroid_radius,
+                                            cache_dir=datasets.CACHE_DIR)
+        dataloader = data.DataLoader(dataset, num_workers=4, pin_memory=True,
+                                     persistent_workers=True)  # reused for both models
 
         # Once for bestndn and once for bestnsn
         for model_name, model_rel in [('bestndn', self.BestNDN),
@@ -86,69 +88,59 @@ class SemanticMetrics(dj.Computed):
             net = train.QCANet.load_model(key, model_name)
             net.cuda()
             net.eval()
+            torch.backends.cudnn.benchmark = True  # chunks have fixed size
 
             # Iterate over images
             num_thresholds = 41
             thresholds = np.linspace(0, 1, num_thresholds)
-            detection_tps = np.zeros(num_thresholds)  # true positives
-            detection_fps = np.zeros(num_thresholds)  # false positives
-            detection_tns = np.zeros(num_thresholds)  # true negatives
-            detection_fns = np.zeros(num_thresholds)  # false negatives
-            segmentation_tps = np.zeros(num_thresholds)
-            segmentation_fps = np.zeros(num_thresholds)
-            segmentation_tns = np.zeros(num_thresholds)
-            segmentation_fns = np.zeros(num_thresholds)
+            gpu_thresholds = torch.as_tensor(thresholds, dtype=torch.float32).cuda()
+            detection_cm = np.zeros((num_thresholds, 4))  # tp, fp, tn, fn per threshold
+            segmentation_cm = np.zeros((num_thresholds, 4))
             for volume, label, centroids in dataloader:
-                # Get predictions
-                with torch.no_grad():
-                    detection, segmentation = net.forward_on_big_input(volume)
-                    detection = torch.sigmoid(detection).squeeze().numpy()
-                    segmentation = torch.sigmoid(segmentation).squeeze().numpy()
-
-                # Compute voxel-wise confusion matrix
-                for i, threshold in enumerate(thresholds):
-                    tp, fp, tn, fn = compute_confusion_matrix(detection > threshold,
-                                                              centroids[0].numpy())
-                    detection_tps[i] += tp
-                    detection_fps[i] += fp
-                    detection_tns[i] += tn
-                    detection_fns[i] += fn
-
-                    tp, fp, tn, fn = compute_confusion_matrix(segmentation > threshold,
-                                                              label[0].numpy())
-                    segmentation_tps[i] += tp
-                    segmentation_fps[i] += fp
-                    segmentation_tns[i] += tn
-                    segmentation_fns[i] += fn
+                # Move ground truth to GPU (once per volume)
+                centroids = centroids[0].cuda(non_blocking=True).bool()
+                label = label[0].cuda(non_blocking=True).bool()
+
+                # Get predictions (once per volume, reused for every threshold)
+                with torch.inference_mode():
+                    detection, segmentation = net.forward_on_big_input(volume)  # in CPU
+                    detection = detection.cuda().sigmoid_().squeeze()  # outputs to GPU
+                    segmentation = segmentation.cuda().sigmoid_().squeeze()
+
+                # Compute voxel-wise confusion matrix at all thresholds
+                detection_cm += compute_confusion_matrices(detection, centroids,
+                                                           gpu_thresholds).cpu().numpy()
+                segmentation_cm += compute_confusion_matrices(segmentation, label,
+                                                              gpu_thresholds).cpu().numpy()
 
                 del volume, label, centroids, detection, segmentation
 
             # Compute metrics
-            detection_metrics = compute_metrics(detection_tps, detection_fps,
-                                                detection_tns, detection_fns)
-            segmentation_metrics = compute_metrics(segmentation_tps, segmentation_fps,
-                                                   segmentation_tns, segmentation_fns)
+            detection_metrics = compute_metrics(*detection_cm.T)
+            segmentation_metrics = compute_metrics(*segmentation_cm.T)
 
-            # Insert
+            # Insert (all thresholds in a single query)
             self.insert1(key, skip_duplicates=True)
+            rows = []
             for (threshold, detection_iou, detection_f1, detection_accuracy, _,
                  detection_specificity, detection_precision, detection_recall,
                  segmentation_iou, segmentation_f1, segmentation_accuracy, _,
                  segmentation_specificity, segmentation_precision, segmentation_recall) \
                     in zip(thresholds, *detection_metrics, *segmentation_metrics):
-                model_rel.insert1({**key, 'threshold': threshold,
-                                   'detection_iou': detection_iou,
-                                   'detection_f1': detection_f1,
-                                   'detection_accuracy': detection_accuracy,
-                                   'detection_specificity': detection_specificity,
-                                   'detection_precision': detection_precision,
-                                   'detection_recall': detection_recall,
-                                   'segmentation_iou': segmentation_iou,
-                                   'segmentation_f1': segmentation_f1,
-                                   'segmentation_accuracy': segmentation_accuracy,
-                                   'segmentation_specificity': segmentation_specificity,
-                                   'segmentation_precision': segmentation_precision,
-                                   'segmentation_recall': segmentation_recall})
+                rows.append({**key, 'threshold': threshold,
+                             'detection_iou': detection_iou,
+                             'detection_f1': detection_f1,
+                             'detection_accuracy': detection_accuracy,
+                             'detection_specificity': detection_specificity,
+                             'detection_precision': detection_precision,
+                             'detection_recall': detection_recall,
+                             'segmentation_iou': segmentation_iou,
+                             'segmentation_f1': segmentation_f1,
+                             'segmentation_accuracy': segmentation_accuracy,
+                             'segmentation_specificity': segmentation_specificity,
+                             'segmentation_precision': segmentation_precision,
+                             'segmentation_recall': segmentation_recall})
+            model_rel.insert(rows)
 
 
 @schema
@@ -158,6 +150,8 @@ class InstanceMetrics(dj.Computed):
     -> train.QCANet
     -> params.EvalSet
     """
+    n_jobs = 4  # processes matching instances at once; each holds its own full-volume
+                # labels, masks and watershed buffers, so peak RAM grows with n_jobs
 
     @property
     def key_source(self):
@@ -231,6 +225,7 @@ class InstanceMetrics(dj.Computed):
 
     def make(self, key):
         from skimage import measure
+        from joblib import Parallel, delayed
 
         print('Evaluating', key)
 
@@ -242,8 +237,10 @@ class InstanceMetrics(dj.Computed):
         dataset = datasets.DetectionDataset(examples, transforms.ContrastNorm(),
                                             normalize_volume=normalize_volume,
                                             centroid_radius=centroid_radius,
-                                            binarize_labels=False)
-        dataloader = data.DataLoader(dataset, num_workers=4, pin_memory=True)
+                                            binarize_labels=False,
+                                            cache_dir=datasets.CACHE_DIR)
+        dataloader = data.DataLoader(dataset, num_workers=4, pin_memory=True,
+                                     persistent_workers=True)  # reused for both models
 
         # Once for bestndn and once for bestnsn
         for model_name, mucov_rel, ap_rel in [
@@ -254,6 +251,7 @@ class InstanceMetrics(dj.Computed):
             net = train.QCANet.load_model(key, model_name)
             net.cuda()
             net.eval()
+            torch.backends.cudnn.benchmark = True  # chunks have fixed size
 
             # Set some parameters
             num_thresholds = 13
@@ -266,68 +264,30 @@ class InstanceMetrics(dj.Computed):
             num_gt_instances = np.zeros(num_thresholds)  # number of ground truth instances
             num_pred_instances = np.zeros(num_thresholds)  # number of predicted masks
             confidences = [[] for _ in range(num_thresholds)]  # confidence per predicted mask
-            tps = [np.empty([num_ious, 0], dtype=bool) for _ in range(num_thresholds)]  # ious x sorted_masks, whether mask is a match
+            tps = [[] for _ in range(num_thresholds)]  # ious x masks per example, whether mask is a match
             for volume, label, centroids in dataloader:
                 # Get predictions
-                with torch.no_grad():
+                with torch.inference_mode():
                     detection, segmentation = net.forward_on_big_input(volume)
                     detection = torch.sigmoid(detection).squeeze().numpy()
                     segmentation = torch.sigmoid(segmentation).squeeze().numpy()
                     label = label[0].numpy()
 
-                for i, threshold in enumerate(thresholds):
-                    # Create instance segmentation
-                    masks = utils.prob2labels(detection, segmentation, threshold)
-                    mask_properties = measure.regionprops(masks, segmentation)
-                    probs = [p.mean_intensity for p in mask_properties]
-
-                    # Match each predicted mask to a ground truth mask
-                    mask_tps = np.zeros([num_ious, len(probs)], dtype=bool)
-                    gt_tps = np.zeros([num_ious, label.max()], dtype=bool)
-                    mask_bboxes = np.array([p.bbox for p in mask_properties])
-                    gt_bboxes = np.array([p.bbox for p in measure.regionprops(label)])
-                    for mask_id, _ in sorted(enumerate(probs), key=lambda x: x[1],
-                                             reverse=True):
-                        # Find bbox containing mask and any overlapping gt object
-                        mask_bbox = mask_bboxes[mask_id]
-                        mask_slices = (slice(mask_bbox[0], mask_bbox[3]),
-                                       slice(mask_bbox[1], mask_bbox[4]),
-                                       slice(mask_bbox[2], mask_bbox[5]))
-                        gt_ids = np.unique(label[mask_slices][masks[mask_slices] ==
-                                                              (mask_id + 1)])
-                        gt_indices = gt_ids[gt_ids != 0] - 1
-                        overlapping_bboxes = gt_bboxes[gt_indices]
-
-                        all_bboxes = np.concatenate([mask_bbox[None], overlapping_bboxes])
-                        low_coords = np.min(all_bboxes[:, :3], axis=0)
-                        high_coords = np.max(all_bboxes[:, 3:], axis=0)
-                        full_slices = tuple(slice(l, h) for l, h in zip(low_coords,
-                                                                        high_coords))
-
-                        # Find all overlapping ground truth objects
-                        matches = find_matches(label[full_slices],
-                                               masks[full_slices] == (mask_id + 1))
-                        sorted_matches = sorted(matches, reverse=True)
-
-                        # Accumulate highest IOU for this predicted mask
-                        if sorted_matches:
-                            total_best_ious[i] += sorted_matches[0][0]
-
-                        # Assign mask to highest overlap match in ground truth label
-                        for iou, match in sorted_matches:
-                            is_acceptable = iou > acceptance_ious
-                            is_unassigned = ~np.logical_or(gt_tps[:, match - 1],
-                                                           mask_tps[:, mask_id])
-                            mask_tps[:, mask_id] = np.logical_and(is_acceptable,
-                                                                  is_unassigned)
-                            gt_tps[:, match - 1] = np.logical_and(is_acceptable,
-                                                                  is_unassigned)
-
-                    # Accumulate results
+                # Create and match instance segmentations (thresholds split among n_jobs processes)
+                gt_bboxes = np.array([p.bbox for p in measure.regionprops(label)])
+                n_jobs = min(len(thresholds), self.n_jobs)
+                results = Parallel(n_jobs=n_jobs, backend='loky')(delayed(utils.match_instances)(
+                    detection, segmentation, label, gt_bboxes, threshold,
+                    acceptance_ious) for threshold in thresholds)
+
+                # Accumulate results
+                for i, (best_iou, probs, mask_tps) in enumerate(results):
+                    total_best_ious[i] += best_iou
                     num_gt_instances[i] += label.max()
                     num_pred_instances[i] += len(probs)
                     confidences[i].extend(probs)
-                    tps[i] = np.concatenate([tps[i], mask_tps], axis=1)
+                    tps[i].append(mask_tps)
+            tps = [np.concatenate(tps_, axis=1) for tps_ in tps]  # concatenate once
 
             # Compute MuCov
             mucov = total_best_ious / num_pred_instances
@@ -351,8 +311,8 @@ class InstanceMetrics(dj.Computed):
                 precision = np.maximum.accumulate(precision[:, ::-1], 1)[:, ::-1]
 
                 # Compute mAP (area under the precision recall curve)
-                precisions[i] = [[p[bisect.bisect_left(r, i)] for i in np.linspace(0, 1, 11)]
-                                 for p, r in zip(precision, recall)]
+                precisions[i] = [p[np.searchsorted(r, np.linspace(0, 1, 11))] for p, r in
+                                 zip(precision, recall)]
             aps = np.mean(precisions, axis=-1)  # thresholds x ious
 
             # Compute other metrics
@@ -361,38 +321,84 @@ class InstanceMetrics(dj.Computed):
                               num_gt_instances[:, None] - tps)
             _, f1, _, _, _, precision, recall = compute_metrics(tp, fp, tn, fn)
 
-            # Insert
+            # Insert (all thresholds and ious in a single query per table)
             self.insert1(key, skip_duplicates=True)
-            for threshold, mucov_ in zip(thresholds, mucov):
-                mucov_rel.insert1({**key, 'threshold': threshold, 'mucov': mucov_})
+            mucov_rel.insert([{**key, 'threshold': threshold, 'mucov': mucov_} for
+                              threshold, mucov_ in zip(thresholds, mucov)])
+            ap_rows = []
             for threshold_, row_precisions, row_aps, row_precision, row_recall, row_f1 in zip(
                     thresholds, precisions, aps, precision, recall, f1):
                 for iou_, precisions_, ap_, precision_, recall_, f1_ in zip(
                         acceptance_ious, row_precisions, row_aps, row_precision,
                         row_recall, row_f1):
-                    ap_rel.insert1({**key, 'threshold': threshold_, 'iou': iou_,
+                    ap_rows.append({**key, 'threshold': threshold_, 'iou': iou_,
                                     'precisions': precisions_, 'ap': ap_,
                                     'precision': precision_, 'recall': recall_,
                                     'f1': f1_})
+            ap_rel.insert(ap_rows)
 
 
-def compute_confusion_matrix(segmentation, label):
-    """Confusion matrix for a single image: # of pixels in each category.
+def populate_in_parallel(table, num_gpus, *restrictions):
+    """ Populate a metrics table using one process per GPU.
+
+    Keys are split among processes via DataJoint's job reservation (each process calls
+    populate with reserve_jobs=True), so every key is evaluated once by a single model on
+    a single GPU. CPUs are split evenly among processes (caps InstanceMetrics.n_jobs).
 
     Arguments:
-        segmentation: Boolean array. Predicted segmentation.
-        label: Boolean array. Expected segmentation.
+        table (dj.Computed): Table to populate, e.g., SemanticMetrics.
+        num_gpus (int): Number of GPUs to use. GPUs 0, 1, ..., num_gpus - 1 are used.
+        restrictions: Restrictions passed to populate.
+    """
+    from joblib import Parallel, delayed
+
+    n_jobs = max(1, os.cpu_count() // num_gpus)
+    Parallel(n_jobs=num_gpus, backend='loky')(delayed(_populate_on_gpu)(
+        table, gpu_id, n_jobs, restrictions) for gpu_id in range(num_gpus))
+
+
+def _populate_on_gpu(table, gpu_id, n_jobs, restrictions):
+    """ Populate table in the current process using GPU gpu_id and n_jobs CPUs."""
+    torch.cuda.set_device(gpu_id)  # default device for .cuda() in this process
+    rel = table()
+    if hasattr(rel, 'n_jobs'):
+        rel.n_jobs = min(rel.n_jobs, n_jobs)  # never more than this worker's CPUs
+    rel.populate(*restrictions, reserve_jobs=True)
+
+
+def compute_confusion_matrices(probs, label, thresholds):
+    """ Confusion matrices for a single image at many thresholds.
+
+    Each voxel is binned once by the number of thresholds below its probability; a
+    histogram of bins for positive and negative voxels then gives the number of voxels
+    above each threshold (as a suffix sum), rather than thresholding the entire volume
+    once per threshold.
+
+    Arguments:
+        probs: Tensor. Predicted probabilities; voxels with probs > threshold are
+            considered positive.
+        label: Boolean tensor. Expected segmentation. Same shape and device as probs.
+        thresholds: Tensor. Thresholds to evaluate in increasing order. Same dtype and
+            device as probs.
 
     Returns:
-        A quadruple with true positives, false positives, true negatives and false
-            negatives
+        A num_thresholds x 4 tensor with true positives, false positives, true negatives
+            and false negatives at each threshold.
     """
-    true_positive = np.logical_and(segmentation, label).sum()
-    false_positive = np.logical_and(segmentation, np.logical_not(label)).sum()
-    true_negative = np.logical_and(np.logical_not(segmentation), np.logical_not(label)).sum()
-    false_negative = np.logical_and(np.logical_not(segmentation), label).sum()
+    bins = torch.bucketize(probs, thresholds, out_int32=True)  # probs > thresholds[:bins]
+    bins.mul_(2).add_(label)  # index 2 * bin + label, in place (no ~label or temporaries)
+    histogram = torch.bincount(bins.view(-1), minlength=2 * (len(thresholds) + 1))
+    histogram = histogram.view(-1, 2)  # negatives, positives per bin
+    negatives, positives = histogram[:, 0], histogram[:, 1]
+
+    # Voxels above threshold i are those in bins i + 1 and higher
+    true_positive = positives.flip(0).cumsum(0).flip(0)[1:]
+    false_positive = negatives.flip(0).cumsum(0).flip(0)[1:]
+    true_negative = negatives.sum() - false_positive
+    false_negative = positives.sum() - true_positive
 
-    return (true_positive, false_positive, true_negative, false_negative)
+    return torch.stack([true_positive, false_positive, true_negative, false_negative],
+                       dim=1)
 
 
 def compute_metrics(true_positive, false_positive, true_negative, false_negative):
@@ -421,25 +427,3 @@ def compute_metrics(true_positive, false_positive, true_negative, false_negative
     f1 = (2 * precision * recall) / (precision + recall + epsilon)
 
     return iou, f1, accuracy, sensitivity, specificity, precision, recall
-
-
-def find_matches(labels, prediction):
-    """ Find all labels that intersect with a given predicted mask (and their IOUs).
-
-    Arguments:
-        labels: Array with zeros for background and positive integers for each ground
-            truth object in the volume.
-        prediction: Boolean array with ones for the predicted mask. Same shape as labels.
-
-    Returns:
-        List of (iou, label) pairs.
-    """
-    res = []
-    for m in filter(lambda x: x != 0, np.unique(labels[prediction])):
-        label = labels == m
-        union = np.logical_or(label, prediction)
-        intersection = np.logical_and(label[union], prediction[union]) # bit faster
-        iou = np.count_nonzero(intersection) / np.count_nonzero(union)
-        res.append((iou, m))
-
-    return res
\ No newline at end of file
@@ -126,17 +126,30 @@ def prob2labels(detection, segmentation_, seg_threshold=0.5, min_voxels=65,
             integer ids for each predicted instance.
     """
     from skimage import feature, morphology, measure, segmentation
+    from scipy import sparse, spatial
+    from scipy.sparse import csgraph
 
     # Create binary segmentation
     binary_masks = segmentation_ > seg_threshold
 
+    # Find centroids
+    coords = feature.peak_local_max(detection, footprint=morphology.ball(4),
+                                    exclude_border=False)
+    coords = coords[binary_masks[tuple(coords.T)]]  # restrict to peaks in cell bodies
+    coords = coords[np.lexsort(coords.T[::-1])]  # raster order
+
+    # Merge touching peaks (plateaus) into a single marker, as morphology.label(peaks)
+    pairs = spatial.cKDTree(coords).query_pairs(1, p=np.inf, output_type='ndarray')
+    adjacency = sparse.coo_matrix((np.ones(len(pairs)), tuple(pairs.T)),
+                                  shape=(len(coords), len(coords)))
+    _, marker_ids = csgraph.connected_components(adjacency, directed=False)
+
     # Watershed segmentation using centroids from detection
-    peaks = feature.peak_local_max(detection, footprint=morphology.ball(4), indices=False,
-                                   exclude_border=False)
-    peaks[~binary_masks] = False # restrict to peaks in cell bodies
-    masks = morphology.watershed(-segmentation_, morphology.label(peaks).astype(np.int32),
-                                 mask=binary_masks, connectivity=3,
-                                 compactness=compactness_factor).astype(np.int32)
+    markers = np.zeros(detection.shape, dtype=np.int32)
+    markers[tuple(coords.T)] = marker_ids + 1  # ids numbered in raster order
+    masks = segmentation.watershed(-segmentation_, markers, mask=binary_masks,
+                                   connectivity=3,
+                                   compactness=compactness_factor).astype(np.int32)
     print(masks.max(), 'initial cells')
 
     # Remove masks that are too small or too big (usually bad detections)
@@ -147,4 +160,97 @@ def prob2labels(detection, segmentation_, seg_threshold=0.5, min_voxels=65,
     label = label.astype(np.int32)
     print(label.max(), 'final cells')
 
-    return label
\ No newline at end of file
+    return label
+
+
+def find_matches(labels, prediction):
+    """ Find all labels that intersect with a given predicted mask (and their IOUs).
+
+    Arguments:
+        labels: Array with zeros for background and positive integers for each ground
+            truth object in the volume.
+        prediction: Boolean array with ones for the predicted mask. Same shape as labels.
+
+    Returns:
+        List of (iou, label) pairs.
+    """
+    intersections = np.bincount(labels[prediction])  # overlap of each label with mask
+    label_sizes = np.bincount(labels.ravel())[:len(intersections)]
+    ids = np.nonzero(intersections)[0]
+    ids = ids[ids != 0]  # ignore background
+
+    unions = label_sizes[ids] + np.count_nonzero(prediction) - intersections[ids]
+    ious = intersections[ids] / unions
+
+    return list(zip(ious, ids))
+
+
+def match_instances(detection, segmentation, label, gt_bboxes, threshold,
+                    acceptance_ious):
+    """ Create an instance segmentation at a given threshold and match each predicted
+    mask to the ground truth objects.
+
+    Predicted masks are visited in order of decreasing confidence and assigned to the
+    unassigned ground truth object with highest IOU (if that IOU is above the acceptance
+    IOU).
+
+    Arguments:
+        detection: 3-d probability heatmap for centroids.
+        segmentation: 3-d probability heatmap for cell bodies.
+        label: Array with zeros for background and positive integers for each ground
+            truth object in the volume.
+        gt_bboxes: Array (num_objects x 6). Bounding box of each ground truth object (as
+            returned by skimage.measure.regionprops).
+        threshold: Threshold for the segmentation heatmap.
+        acceptance_ious: Array. Minimum IOU for a predicted mask to count as a match.
+
+    Returns:
+        A (best_iou, probs, mask_tps) triplet:
+            best_iou (float): Sum over predicted masks of their highest IOU with any
+                ground truth object.
+            probs (list): Confidence (mean probability) of each predicted mask.
+            mask_tps (np.array): A num_ious x num_masks boolean array: whether each
+                predicted mask is a match at each acceptance IOU.
+    """
+    from skimage import measure
+
+    # Create instance segmentation
+    masks = prob2labels(detection, segmentation, threshold)
+    mask_properties = measure.regionprops(masks, segmentation)
+    probs = [p.mean_intensity for p in mask_properties]
+
+    # Match each predicted mask to a ground truth mask
+    best_iou = 0
+    mask_tps = np.zeros([len(acceptance_ious), len(probs)], dtype=bool)
+    gt_tps = np.zeros([len(acceptance_ious), label.max()], dtype=bool)
+    mask_bboxes = np.array([p.bbox for p in mask_properties])
+    for mask_id, _ in sorted(enumerate(probs), key=lambda x: x[1], reverse=True):
+        # Find bbox containing mask and any overlapping gt object
+        mask_bbox = mask_bboxes[mask_id]
+        mask_slices = (slice(mask_bbox[0], mask_bbox[3]), slice(mask_bbox[1], mask_bbox[4]),
+                       slice(mask_bbox[2], mask_bbox[5]))
+        gt_ids = np.unique(label[mask_slices][masks[mask_slices] == (mask_id + 1)])
+        gt_indices = gt_ids[gt_ids != 0] - 1
+        overlapping_bboxes = gt_bboxes[gt_indices]
+
+        all_bboxes = np.concatenate([mask_bbox[None], overlapping_bboxes])
+        low_coords = np.min(all_bboxes[:, :3], axis=0)
+        high_coords = np.max(all_bboxes[:, 3:], axis=0)
+        full_slices = tuple(slice(l, h) for l, h in zip(low_coords, high_coords))
+
+        # Find all overlapping ground truth objects
+        matches = find_matches(label[full_slices], masks[full_slices] == (mask_id + 1))
+        sorted_matches = sorted(matches, reverse=True)
+
+        # Accumulate highest IOU for this predicted mask
+        if sorted_matches:
+            best_iou += sorted_matches[0][0]
+
+        # Assign mask to highest overlap match in ground truth label
+        for iou, match in sorted_matches:
+            is_acceptable = iou > acceptance_ious
+            is_unassigned = ~np.logical_or(gt_tps[:, match - 1], mask_tps[:, mask_id])
+            mask_tps[:, mask_id] = np.logical_and(is_acceptable, is_unassigned)
+            gt_tps[:, match - 1] = np.logical_and(is_acceptable, is_unassigned)
+
+    return best_iou, probs, mask_tps
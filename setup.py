@@ -11,7 +11,7 @@ setup(
     url='https://github.com/cajal/bl3d',
     keywords= '2p 3d GCaMPs soma segmentation stack',
     packages=['bl3d'],
-    install_requires=['torch', 'numpy', 'scipy', 'scikit-image', 'datajoint',],
+    install_requires=['torch', 'numpy', 'scipy', 'scikit-image', 'datajoint', 'joblib'],
     classifiers=[
         'Development Status :: 3 - Alpha',
         'Intended Audience :: Science/Research',